@@ -0,0 +1,200 @@
+""" quality filtering of projected glyph bounding boxes.  every glyph of a frame
+is checked at once, as an array of quads, instead of one glyph at a time.
+
+a quad is a glyph's four corners in the order top left, top right, bottom right,
+bottom left, as returned by world_to_camera_view: normalized x and y, with y
+pointing up, and z the distance in front of the camera.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+MIN_ASPECT = 1/15.0
+MAX_ASPECT = 3
+# in square pixels
+MIN_AREA = 1.0
+# the fraction of a glyph's quad that a nearer glyph's quad may cover before we
+# consider it hidden behind a fold of the receipt
+MAX_OVERLAP = 0.5
+# how much nearer to the camera, in heights of the covered glyph, a glyph must
+# be to hide it.  neighboring glyphs on a tilted receipt are only ever a
+# fraction of a glyph nearer than each other, while a fold is far more
+MIN_OCCLUDER_DEPTH = 0.5
+# how many glyphs to test against each other at a time when looking for
+# occlusion, which bounds the size of our pairwise arrays
+OCCLUSION_CHUNK = 256
+
+
+def to_render_space(quads, render_size):
+    """ converts (N, 4, 2+) normalized quads into (N, 4, 2) pixel coordinates
+    with 0,0 in the upper left """
+    width, height = render_size
+    pts = np.empty(quads.shape[:2] + (2,), dtype=np.float64)
+    pts[..., 0] = quads[..., 0] * width
+    pts[..., 1] = (1.0 - quads[..., 1]) * height
+    return pts
+
+
+def signed_areas(pts):
+    """ shoelace area of each quad.  in render space, a glyph seen from the
+    front winds clockwise on screen and has a positive area """
+    x = pts[..., 0]
+    y = pts[..., 1]
+    x_next = np.roll(x, -1, axis=1)
+    y_next = np.roll(y, -1, axis=1)
+    return (x * y_next - x_next * y).sum(axis=1) / 2.0
+
+
+def is_twisted(pts):
+    """ a quad whose consecutive edges don't all turn the same way is either
+    concave or crosses over itself, neither of which a flat glyph can do
+    without the paper folding through it """
+    edges = np.roll(pts, -1, axis=1) - pts
+    next_edges = np.roll(edges, -1, axis=1)
+    turns = edges[..., 0] * next_edges[..., 1] - \
+            edges[..., 1] * next_edges[..., 0]
+    return ~((turns > 0).all(axis=1) | (turns < 0).all(axis=1))
+
+
+def clip_polygon(subject, clip):
+    """ clips the polygon subject to the convex polygon clip, both lists of
+    (x, y) points.  returns the polygon where they overlap, which may be empty
+    """
+    n = len(clip)
+    if shoelace(clip) < 0:
+        clip = clip[::-1]
+
+    output = list(subject)
+    for i in range(n):
+        if not output:
+            break
+        (ax, ay), (bx, by) = clip[i], clip[(i+1) % n]
+
+        # positive on the inside of this edge of clip
+        def side(p):
+            return (bx - ax) * (p[1] - ay) - (by - ay) * (p[0] - ax)
+
+        points = output
+        output = []
+        for k, cur in enumerate(points):
+            prev = points[k-1]
+            cur_side = side(cur)
+            prev_side = side(prev)
+            if (cur_side >= 0) != (prev_side >= 0):
+                t = prev_side / (prev_side - cur_side)
+                output.append((prev[0] + t * (cur[0] - prev[0]),
+                    prev[1] + t * (cur[1] - prev[1])))
+            if cur_side >= 0:
+                output.append(cur)
+
+    return output
+
+
+def shoelace(points):
+    """ signed area of a polygon given as a list of (x, y) points """
+    area = 0.0
+    for k, (x, y) in enumerate(points):
+        px, py = points[k-1]
+        area += px * y - x * py
+    return area / 2.0
+
+
+def find_occluded(pts, depths, candidates, glyph_sizes=None,
+        max_overlap=MAX_OVERLAP, min_depth=MIN_OCCLUDER_DEPTH):
+    """ finds the candidate glyphs whose quad is mostly covered by the quad of
+    another candidate that is nearer by at least min_depth of the covered
+    glyph's size.  glyph_sizes are the glyphs' heights in the same units as
+    depths, and without them any nearer glyph counts.  glyphs on a smooth
+    stretch of paper don't overlap each other, so this only happens where the
+    receipt folds over itself.  the quads must be convex, which the twisted
+    check makes sure of """
+    occluded = np.zeros(len(pts), dtype=bool)
+    idxs = np.nonzero(candidates)[0]
+    if len(idxs) < 2:
+        return occluded
+
+    pts = pts[idxs]
+    depths = depths[idxs]
+    margins = np.zeros(len(idxs))
+    if glyph_sizes is not None:
+        margins = min_depth * glyph_sizes[idxs]
+
+    boxes = np.concatenate([pts.min(axis=1), pts.max(axis=1)], axis=1)
+    areas = np.abs(signed_areas(pts))
+
+    for start in range(0, len(idxs), OCCLUSION_CHUNK):
+        chunk = slice(start, start + OCCLUSION_CHUNK)
+        b = boxes[chunk, None, :]
+
+        # two quads can't overlap by more than their boxes do, so the boxes
+        # narrow down the pairs that we clip the quads themselves for
+        overlap_w = np.minimum(b[..., 2], boxes[:, 2]) - \
+                np.maximum(b[..., 0], boxes[:, 0])
+        overlap_h = np.minimum(b[..., 3], boxes[:, 3]) - \
+                np.maximum(b[..., 1], boxes[:, 1])
+        overlap = np.clip(overlap_w, 0, None) * np.clip(overlap_h, 0, None)
+
+        limits = max_overlap * areas[chunk, None]
+        covered = overlap > limits
+        nearer = depths[None, :] < depths[chunk, None] - margins[chunk, None]
+
+        for i, j in zip(*np.nonzero(covered & nearer)):
+            glyph = start + i
+            if occluded[idxs[glyph]]:
+                continue
+            inside = clip_polygon(pts[glyph].tolist(), pts[j].tolist())
+            if len(inside) > 2 and abs(shoelace(inside)) > limits[i, 0]:
+                occluded[idxs[glyph]] = True
+
+    return occluded
+
+
+def filter_quads(quads, render_size, glyph_sizes=None, min_aspect=MIN_ASPECT,
+        max_aspect=MAX_ASPECT, min_area=MIN_AREA, max_overlap=MAX_OVERLAP):
+    """ takes (N, 4, 3) projected glyph quads and returns a boolean mask of the
+    glyphs worth keeping, along with an ordered mapping of rejection reason to
+    the number of glyphs rejected for it.  glyph_sizes are the glyphs' heights
+    in the same units as the quads' depths, for telling folds apart from a
+    tilted receipt """
+    width, height = render_size
+    pts = to_render_space(quads, render_size)
+    depths = quads[..., 2]
+
+    mins = pts.min(axis=1)
+    maxs = pts.max(axis=1)
+    box_w = maxs[:, 0] - mins[:, 0]
+    box_h = maxs[:, 1] - mins[:, 1]
+    areas = signed_areas(pts)
+
+    # zero heights get rejected as degenerate, so we don't want to hear about
+    # dividing by them here
+    with np.errstate(divide="ignore", invalid="ignore"):
+        aspect = box_w / box_h
+
+    checks = OrderedDict()
+    checks["behind_camera"] = (depths <= 0).any(axis=1)
+    checks["off_frame"] = (mins[:, 0] < 0) | (mins[:, 1] < 0) | \
+            (maxs[:, 0] > width) | (maxs[:, 1] > height)
+    checks["degenerate"] = (np.abs(areas) < min_area) | (box_w <= 0) | \
+            (box_h <= 0)
+    checks["twisted"] = is_twisted(pts)
+    checks["back_facing"] = areas < 0
+    checks["aspect"] = ~((aspect >= min_aspect) & (aspect <= max_aspect))
+
+    keep = np.ones(len(quads), dtype=bool)
+    counts = OrderedDict()
+    for reason, failed in checks.items():
+        failed = failed & keep
+        counts[reason] = int(failed.sum())
+        keep &= ~failed
+
+    # occlusion is the only pairwise check, so it runs last, on the fewest
+    # glyphs
+    occluded = find_occluded(pts, depths.mean(axis=1), keep, glyph_sizes,
+            max_overlap)
+    counts["occluded"] = int(occluded.sum())
+    keep &= ~occluded
+
+    return keep, counts
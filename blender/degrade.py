@@ -0,0 +1,156 @@
+""" cheap photometric degradation of rendered frames.  exposure shifts, blur,
+sensor noise and jpeg artifacts would otherwise take a whole new cycles render
+each, but none of them move anything in the frame, so we can apply them to a
+frame we already have and keep its bounding boxes as they are.
+
+a config maps each operation to the chance of applying it and the ranges its
+parameters are drawn uniformly from.  operations always run in the order of
+OPS, which is the order they'd happen in a real camera.
+"""
+
+import io
+import sys
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+
+OPS = ("exposure", "blur", "noise", "jpeg")
+
+DEFAULT_CONFIG = {
+    # exposure change in stops, and a gamma for the tone curve
+    "exposure": {"prob": 0.8, "stops": [-1.0, 1.0], "gamma": [0.8, 1.25]},
+    # gaussian blur radius in pixels, for focus and motion softness
+    "blur": {"prob": 0.5, "radius": [0.3, 2.0]},
+    # read noise is a constant sigma, in 0-255 levels.  shot noise has a sigma
+    # of this times the square root of the pixel's level
+    "noise": {"prob": 0.7, "read": [0.0, 6.0], "shot": [0.0, 1.5]},
+    "jpeg": {"prob": 0.5, "quality": [20, 90]},
+}
+
+
+def load_config(path):
+    """ loads a json config, falling back to DEFAULT_CONFIG for whatever
+    operations and settings it leaves out """
+    with open(path, "r") as h:
+        overrides = json.load(h)
+
+    unknown = set(overrides) - set(OPS)
+    if unknown:
+        raise ValueError("unknown degradation operations: %s"
+                % ", ".join(sorted(unknown)))
+
+    config = {}
+    for op in OPS:
+        config[op] = dict(DEFAULT_CONFIG[op])
+        config[op].update(overrides.get(op, {}))
+    return config
+
+
+def exposure(pixels, rng, settings):
+    stops = rng.uniform(*settings["stops"])
+    gamma = rng.uniform(*settings["gamma"])
+    normed = np.clip(pixels / 255.0 * (2.0 ** stops), 0, 1)
+    return normed ** gamma * 255.0, {"stops": stops, "gamma": gamma}
+
+
+def blur(pixels, rng, settings):
+    radius = rng.uniform(*settings["radius"])
+    im = to_image(pixels).filter(ImageFilter.GaussianBlur(radius))
+    return np.asarray(im, dtype=np.float32), {"radius": radius}
+
+
+def noise(pixels, rng, settings):
+    read = rng.uniform(*settings["read"])
+    shot = rng.uniform(*settings["shot"])
+    sigma = np.sqrt(read ** 2 + shot ** 2 * np.clip(pixels, 0, None))
+    noisy = pixels + rng.standard_normal(pixels.shape) * sigma
+    return noisy, {"read": read, "shot": shot}
+
+
+def jpeg(pixels, rng, settings):
+    low, high = settings["quality"]
+    quality = int(rng.randint(low, high + 1))
+    buf = io.BytesIO()
+    to_image(pixels).save(buf, "jpeg", quality=quality)
+    buf.seek(0)
+    im = Image.open(buf)
+    return np.asarray(im, dtype=np.float32), {"quality": quality}
+
+
+OP_FNS = {
+    "exposure": exposure,
+    "blur": blur,
+    "noise": noise,
+    "jpeg": jpeg,
+}
+
+
+def to_image(pixels):
+    return Image.fromarray(np.clip(pixels, 0, 255).round().astype(np.uint8),
+            "L")
+
+
+def degrade(im, rng, config=DEFAULT_CONFIG, timings=None):
+    """ makes one degraded copy of the grayscale image im, drawing everything
+    from the numpy RandomState rng.  returns the copy and the parameters of
+    each operation applied.  if timings is a dict, the seconds each operation
+    took are appended to it """
+    pixels = np.asarray(im, dtype=np.float32)
+    params = OrderedDict()
+
+    for op in OPS:
+        settings = config.get(op)
+        if not settings or rng.uniform() >= settings["prob"]:
+            continue
+
+        start = time.time()
+        pixels, params[op] = OP_FNS[op](pixels, rng, settings)
+        if timings is not None:
+            timings.setdefault(op, []).append(time.time() - start)
+
+    return to_image(pixels), params
+
+
+def variants(im, num, rng, config=DEFAULT_CONFIG):
+    """ makes num degraded copies of im, as (image, params) pairs """
+    return [degrade(im, rng, config) for _ in range(num)]
+
+
+def benchmark(im, num, config=DEFAULT_CONFIG, seed=0):
+    """ times making num variants of im, overall and per operation """
+    rng = np.random.RandomState(seed)
+    timings = {}
+    start = time.time()
+    for _ in range(num):
+        degrade(im, rng, config, timings)
+    total = time.time() - start
+
+    results = OrderedDict([("variant_ms", 1000 * total / num)])
+    for op in OPS:
+        times = timings.get(op)
+        if times:
+            results[op + "_ms"] = 1000 * sum(times) / len(times)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="degrade.py",
+            description="Time degrading a rendered frame")
+    parser.add_argument("frame", help="A rendered frame to degrade")
+    parser.add_argument("-n", "--num", metavar="NUM", default=20, type=int,
+            help="How many variants to make")
+    parser.add_argument("--config", metavar="FILE", default=None)
+    ns = parser.parse_args(sys.argv[1:])
+
+    config = DEFAULT_CONFIG
+    if ns.config:
+        config = load_config(ns.config)
+
+    im = Image.open(ns.frame).convert("L")
+    print(json.dumps(benchmark(im, ns.num, config), indent=2))
@@ -0,0 +1,185 @@
+""" a pre-rasterized glyph atlas, shared by every process that draws receipts.
+opening and rasterizing fonts through freetype is slow and takes memory in
+every worker, so we do it once, ahead of time, and save the glyph bitmaps and
+metrics of every whitelisted font into memory-mapped files that all workers
+read from the same page cache.
+
+an atlas for one font size is a directory, fonts/atlas_<size>, holding:
+
+    bitmaps.npy     every glyph's coverage mask, flattened and concatenated
+    metrics.npy     a (fonts, glyphs, 7) int32 array of each glyph's offset into
+                    bitmaps, its drawn width and height, and its tight bounding
+                    box as x1, y1, x2, y2
+    index.json      the font size, the fonts and glyphs along each axis of
+                    metrics, and the fingerprint of what the glyphs were
+                    rasterized with
+
+the fingerprint is the size and modification time of every font file, and the
+versions of pillow and freetype.  an atlas whose fingerprint doesn't match the
+fonts and libraries we'd rasterize with ourselves is stale, and isn't used.
+"""
+
+import sys
+from os.path import join, exists, dirname, basename
+import os
+import json
+import argparse
+from functools import lru_cache
+
+import numpy as np
+import PIL
+from PIL import Image, ImageDraw, ImageFont
+
+import text_gen
+import glyphs
+
+
+BITMAPS_FILE = "bitmaps.npy"
+METRICS_FILE = "metrics.npy"
+INDEX_FILE = "index.json"
+
+
+def atlas_dir(font_dir, size):
+    """ where the atlas for fonts in font_dir lives, next to font_dir """
+    return join(dirname(font_dir.rstrip("/")), "atlas_%d" % size)
+
+
+def fingerprint(font_files):
+    """ everything besides the font size that decides how the glyphs of
+    font_files get rasterized """
+    fonts = {}
+    for font_file in font_files:
+        stat = os.stat(font_file)
+        fonts[basename(font_file)] = [stat.st_size, int(stat.st_mtime)]
+
+    return {
+        "fonts": fonts,
+        "pillow": getattr(PIL, "__version__", None) or
+                getattr(PIL, "PILLOW_VERSION", None),
+        "freetype": getattr(ImageFont.core, "freetype2_version", None),
+    }
+
+
+def rasterize(font, letter):
+    """ draws a glyph the same way text_gen.gen_receipt would, as a coverage
+    mask.  returns the mask and its tight bounding box """
+    w, h = font.getsize(letter)
+    im = Image.new("L", (w, h), 0)
+    draw = ImageDraw.Draw(im)
+    draw.text((0, 0), letter, font=font, fill=255)
+    box = im.getbbox()
+
+    # empty content, like space, will return None for bounding box
+    if not box:
+        box = (0, 0, w, h)
+    return im, box
+
+
+def build_atlas(font_dir, size, out_dir=None):
+    """ rasterizes every glyph of every whitelisted font in font_dir at size """
+    out_dir = out_dir or atlas_dir(font_dir, size)
+    if not exists(out_dir):
+        os.makedirs(out_dir)
+
+    letters = glyphs.get_print_glyphs()
+    font_files = sorted(text_gen.gen_fonts(font_dir))
+
+    metrics = np.zeros((len(font_files), len(letters), 7), dtype=np.int32)
+    bitmaps = []
+    offset = 0
+    for fidx, font_file in enumerate(font_files):
+        font = text_gen.load_font(font_file, size)
+        for gidx, letter in enumerate(letters):
+            im, box = rasterize(font, letter)
+            w, h = im.size
+            metrics[fidx, gidx] = (offset, w, h) + tuple(box)
+            bitmaps.append(np.asarray(im, dtype=np.uint8).ravel())
+            offset += w * h
+
+    np.save(join(out_dir, BITMAPS_FILE), np.concatenate(bitmaps))
+    np.save(join(out_dir, METRICS_FILE), metrics)
+
+    index = {
+        "size": size,
+        "fonts": [basename(f) for f in font_files],
+        "glyphs": letters,
+        "fingerprint": fingerprint(font_files),
+    }
+    with open(join(out_dir, INDEX_FILE), "w") as h:
+        json.dump(index, h)
+
+
+class FontAtlas(object):
+    """ read-only, memory-mapped access to an atlas built by build_atlas """
+
+    def __init__(self, path):
+        with open(join(path, INDEX_FILE), "r") as h:
+            index = json.load(h)
+
+        self.size = index["size"]
+        self.fingerprint = index.get("fingerprint")
+        self.font_idx = {name: i for i, name in enumerate(index["fonts"])}
+        self.glyph_idx = {g: i for i, g in enumerate(index["glyphs"])}
+        self.bitmaps = np.load(join(path, BITMAPS_FILE), mmap_mode="r")
+        self.metrics = np.load(join(path, METRICS_FILE), mmap_mode="r")
+        self._masks = {}
+
+    def __contains__(self, font_name):
+        return font_name in self.font_idx
+
+    def bb_mapping(self, font_name):
+        """ the same mapping of glyph to tight bounding box that
+        text_gen.make_tight_bounder makes for the font """
+        fidx = self.font_idx[font_name]
+        return {g: tuple(int(v) for v in self.metrics[fidx, gidx, 3:])
+                for g, gidx in self.glyph_idx.items()}
+
+    def masks(self, font_name):
+        """ a mapping of glyph to its coverage mask, as images backed by the
+        memory-mapped bitmaps rather than copies of them """
+        if font_name in self._masks:
+            return self._masks[font_name]
+
+        fidx = self.font_idx[font_name]
+        masks = {}
+        for g, gidx in self.glyph_idx.items():
+            offset, w, h = (int(v) for v in self.metrics[fidx, gidx, :3])
+            if not w * h:
+                masks[g] = Image.new("L", (w, h), 0)
+                continue
+            data = self.bitmaps[offset:offset + w*h]
+            masks[g] = Image.frombuffer("L", (w, h), data, "raw", "L", 0, 1)
+
+        self._masks[font_name] = masks
+        return masks
+
+
+@lru_cache(maxsize=None)
+def load_atlas(font_dir, size):
+    """ the atlas for fonts in font_dir at size, or None if it hasn't been
+    built or is stale.  opened once per process """
+    path = atlas_dir(font_dir, size)
+    if not exists(join(path, INDEX_FILE)):
+        return None
+
+    atlas = FontAtlas(path)
+    if atlas.fingerprint != fingerprint(text_gen.gen_fonts(font_dir)):
+        print("not using font atlas %r, it was built from different fonts or "
+                "with a different pillow or freetype, rebuild it with "
+                "build_font_atlas.sh" % path, file=sys.stderr)
+        return None
+    return atlas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="font_atlas.py")
+    parser.add_argument("--fonts", metavar="DIR", default=text_gen.FONT_DIR,
+            help="Directory of fonts to rasterize")
+    parser.add_argument("-s", "--sizes", metavar="SIZE", nargs="+", type=int,
+            default=[text_gen.RECEIPT_FONT_SIZE],
+            help="Font sizes to build atlases for")
+    ns = parser.parse_args(sys.argv[1:])
+
+    for size in ns.sizes:
+        build_atlas(ns.fonts, size)
+        print("built %s" % atlas_dir(ns.fonts, size))
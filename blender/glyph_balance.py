@@ -0,0 +1,129 @@
+""" class balancing for generated receipt text.  left alone, the glyphs of a
+receipt are drawn with fixed probabilities, so rare classes like punctuation
+take many more frames to collect than letters do, and fonts that only have
+uppercase letters fold lowercase labels into the uppercase classes.  a
+GlyphBalancer counts the labels we actually emit and boosts the probability of
+the glyphs whose classes are behind their target share.
+
+counts can be shared between workers through a json file, which every worker
+adds its own counts to under a file lock, replacing the file whole each time.
+"""
+
+import os
+import json
+import fcntl
+from os.path import exists
+
+import numpy as np
+
+import glyphs
+
+
+# how far a class's probability may be pushed up or down from its usual value
+MAX_BOOST = 10.0
+
+
+def load_target(path, classes):
+    """ loads a json mapping of glyph class to relative weight.  classes that
+    aren't mentioned get no weight """
+    with open(path, "r") as h:
+        weights = json.load(h)
+
+    unknown = set(weights) - set(classes)
+    if unknown:
+        raise ValueError("unknown glyph classes in balance target: %s"
+                % "".join(sorted(unknown)))
+    return np.array([weights.get(c, 0) for c in classes], dtype=np.float64)
+
+
+class GlyphBalancer(object):
+    """ tracks the per-class counts of emitted labels, and produces sampling
+    probabilities for glyphs.sample_glyphs that favor the classes furthest
+    below their share of `target`.  target is an array of relative weights,
+    one per class in self.classes, and defaults to all classes equally.
+    `strength` is how hard we push, where 0 doesn't balance at all """
+
+    def __init__(self, counts_file=None, target=None, strength=1.0,
+            max_boost=MAX_BOOST):
+        # spaces only separate words, so they aren't balanced
+        self.glyphs = glyphs.get_sample_glyphs()
+        self.classes = [g for g in self.glyphs if g != " "]
+        self.class_idx = {c: i for i, c in enumerate(self.classes)}
+
+        if target is None:
+            target = np.ones(len(self.classes), dtype=np.float64)
+        self.target = target / target.sum()
+
+        self.counts_file = counts_file
+        self.strength = strength
+        self.max_boost = max_boost
+
+        self.counts = np.zeros(len(self.classes), dtype=np.int64)
+        self.base_probs = glyphs.get_sample_probs()
+
+        if counts_file:
+            self.sync(np.zeros_like(self.counts))
+
+    def probs(self, font):
+        """ sampling probabilities over glyphs.get_sample_glyphs for a receipt
+        in `font`, which decides which class each glyph is labeled as """
+        # laplace smoothing keeps classes we haven't seen yet from getting an
+        # infinite boost
+        share = (self.counts + 1.0) / (self.counts.sum() + len(self.classes))
+        with np.errstate(divide="ignore"):
+            boost = (self.target / share) ** self.strength
+        boost = np.clip(boost, 1.0 / self.max_boost, self.max_boost)
+
+        labels = glyphs.get_label_table(font)
+        probs = self.base_probs.copy()
+        for i, g in enumerate(self.glyphs):
+            if g == " ":
+                continue
+            probs[i] *= boost[self.class_idx[labels[g]]]
+
+        # we only move probability around between the non-space glyphs, so
+        # word lengths stay the same
+        space = self.glyphs.index(" ")
+        non_space = np.arange(len(probs)) != space
+        probs[non_space] *= (1 - probs[space]) / probs[non_space].sum()
+        return probs
+
+    def update(self, labels):
+        """ counts emitted labels, already resolved to their classes.  if
+        counting fails, none of the labels are counted """
+        new = np.zeros_like(self.counts)
+        for label in labels:
+            idx = self.class_idx.get(label)
+            if idx is not None:
+                new[idx] += 1
+
+        if self.counts_file:
+            self.sync(new)
+        else:
+            self.counts = self.counts + new
+
+    def sync(self, new):
+        """ adds new, an array of per-class counts, to the shared counts file,
+        and takes the combined counts of every worker as our own """
+        with open(self.counts_file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                shared = {}
+                if exists(self.counts_file):
+                    with open(self.counts_file, "r") as h:
+                        shared = json.load(h)
+
+                counts = np.array([shared.get(c, 0) for c in self.classes],
+                        dtype=np.int64)
+                counts += new
+
+                # a worker killed partway through writing must not leave the
+                # others a truncated file, so we write a new one and swap it in
+                tmp_file = "%s.%d.tmp" % (self.counts_file, os.getpid())
+                with open(tmp_file, "w") as h:
+                    json.dump(dict(zip(self.classes, counts.tolist())), h)
+                os.replace(tmp_file, self.counts_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.counts = counts
@@ -1,5 +1,7 @@
 import random
+from functools import lru_cache
 from string import ascii_lowercase, ascii_uppercase, digits
+import numpy as np
 import text_gen
 
 _punc = "!@#$%*&()-+='\",?/."
@@ -9,6 +11,11 @@ _char_map = dict(zip(ascii_lowercase, ascii_uppercase))
 # in english
 _AVG_WORD_LENGTH = 5.1
 
+# the chance of a glyph being a space, and of a non-space glyph being a letter or
+# digit instead of punctuation
+SPACE_PROB = 1/(_AVG_WORD_LENGTH-1)
+NORMAL_PROB = 0.8
+
 def resolve_glyph(g, font):
     """ resolve a glyph to its true form.  in practice, this means mapping
     lowercase characters to uppercase """
@@ -16,6 +23,12 @@ def resolve_glyph(g, font):
         g = _char_map.get(g, g)
     return g
 
+@lru_cache(maxsize=None)
+def get_label_table(font):
+    """ a mapping of every printable glyph to the label it gets when drawn in
+    font, so that labeling a whole receipt is one lookup per glyph """
+    return {g: resolve_glyph(g, font) for g in get_print_glyphs()}
+
 def get_orient_glyphs():
     g = ascii_uppercase + ascii_lowercase + digits + _punc
     return g
@@ -32,18 +45,38 @@ def get_print_glyphs():
     return g
 
 def get_glyph():
-    pick_space = random.random() <= (1/(_AVG_WORD_LENGTH-1))
+    pick_space = random.random() <= SPACE_PROB
     if pick_space:
         glyph = " "
     else:
         #glyph = random.choice(digits)
-        pick_normal = random.random() < 0.8
+        pick_normal = random.random() < NORMAL_PROB
         if pick_normal:
             glyph = random.choice(_normal)
         else:
             glyph = random.choice(_punc)
     return glyph
 
+def get_sample_glyphs():
+    """ the glyphs that sample_glyphs draws indices into.  space comes first """
+    return " " + _normal + _punc
+
+def get_sample_probs():
+    """ the probability of each glyph of get_sample_glyphs, matching get_glyph
+    """
+    probs = np.empty(len(get_sample_glyphs()), dtype=np.float64)
+    probs[0] = SPACE_PROB
+    probs[1:len(_normal)+1] = (1-SPACE_PROB) * NORMAL_PROB / len(_normal)
+    probs[len(_normal)+1:] = (1-SPACE_PROB) * (1-NORMAL_PROB) / len(_punc)
+    return probs
+
+def sample_glyphs(rng, num, probs=None):
+    """ draws num glyphs at once from the numpy RandomState rng, as indices into
+    get_sample_glyphs """
+    if probs is None:
+        probs = get_sample_probs()
+    return rng.choice(len(probs), num, p=probs)
+
 def map_dist(dist):
     glyphs = get_glyphs()
     mapping = {glyphs[i]: el for i, el in enumerate(dist) if el}
@@ -0,0 +1,221 @@
+""" writing rendered frames and their annotations to disk.  encoding a big
+frame is slow enough to matter, so a FrameWriter does it in a pool of
+background processes while the next frame renders.  blender holds on to the
+gil for the whole of a render, so writer threads would only get to encode in
+the gaps between renders.  separate processes encode right through them, at
+the cost of pickling each frame across """
+
+import os
+import sys
+import time
+import json
+import threading
+import traceback
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def encode_png(im, path, ns):
+    im.save(path, "png", compress_level=ns.png_level)
+
+def encode_webp(im, path, ns):
+    # pillow's webp encoder only takes rgb and rgba
+    im.convert("RGB").save(path, "webp", lossless=True)
+
+def encode_jpeg(im, path, ns):
+    im.save(path, "jpeg", quality=ns.jpeg_quality)
+
+def encode_npy(im, path, ns):
+    np.save(path, np.asarray(im))
+
+
+# codec name -> (file extension, encode function)
+CODECS = OrderedDict([
+    ("png", (".png", encode_png)),
+    ("webp", (".webp", encode_webp)),
+    ("jpeg", (".jpg", encode_jpeg)),
+    ("npy", (".npy", encode_npy)),
+])
+
+
+def format_error(error):
+    """ the traceback of an error raised in a writer process, which includes
+    the traceback from inside that process """
+    return "".join(traceback.format_exception(type(error), error,
+        error.__traceback__))
+
+
+class CodecStats(object):
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, num_bytes, seconds):
+        self.frames += 1
+        self.bytes += num_bytes
+        self.seconds += seconds
+
+    def summary(self):
+        frames = max(self.frames, 1)
+        return OrderedDict([
+            ("frames", self.frames),
+            ("avg_kb", self.bytes / 1024.0 / frames),
+            ("avg_encode_s", self.seconds / frames),
+        ])
+
+
+def write_frame(codec, options, im, annotation, base_path):
+    """ writes im to base_path plus the codec's extension, and annotation to
+    base_path.json.  runs in a writer process, and returns the size of the
+    encoded image and how long encoding it took """
+    ext, encode = CODECS[codec]
+    image_output = base_path + ext
+
+    start = time.time()
+    encode(im, image_output, options)
+    seconds = time.time() - start
+
+    with open(base_path + ".json", "w") as h:
+        json.dump(annotation, h, indent=2)
+
+    return os.path.getsize(image_output), seconds
+
+
+class FrameWriter(object):
+    """ writes frames with the codec named `codec` in `workers` background
+    processes.  `options` holds the codec settings, png_level and
+    jpeg_quality.  at most `max_pending` frames wait to be written at once,
+    after which submit blocks, so a slow disk can't make us run out of memory.
+    frames that fail to write are appended to the `failures` file, if there is
+    one, as one json object per line """
+
+    def __init__(self, codec, options, workers=2, max_pending=8,
+            failures=None):
+        if codec not in CODECS:
+            raise ValueError("unknown codec %r, expected one of %s"
+                    % (codec, ", ".join(CODECS)))
+
+        self.codec = codec
+        self.ext = CODECS[codec][0]
+        self.options = options
+        self.failures = failures
+
+        self.pool = ProcessPoolExecutor(workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.stats = CodecStats()
+        self.errors = 0
+
+        # the writer processes are forked on the first submit, so we get that
+        # over with while this process is small and isn't rendering
+        self.pool.submit(int).result()
+
+    def submit(self, im, annotation, base_path, written=None):
+        """ queues im to be written to base_path plus the codec's extension,
+        and annotation to base_path.json.  written is an optional function
+        called, on a background thread, once both have been written """
+        self.pending.acquire()
+        future = self.pool.submit(write_frame, self.codec, self.options, im,
+                annotation, base_path)
+        future.add_done_callback(partial(self._done, annotation, base_path,
+            written))
+
+    def _done(self, annotation, base_path, written, future):
+        try:
+            num_bytes, seconds = future.result()
+
+        # we're on a background thread, so nobody would see this exception
+        # unless we report it ourselves
+        except Exception as e:
+            sys.stderr.write(format_error(e))
+            with self.lock:
+                self.errors += 1
+                self.record_failure(base_path, annotation, e)
+            return
+
+        finally:
+            self.pending.release()
+
+        with self.lock:
+            self.stats.add(num_bytes, seconds)
+        if written:
+            written()
+
+    def record_failure(self, base_path, annotation, error):
+        """ appends a frame's write error to the failures file """
+        if not self.failures:
+            return
+
+        failure = {
+            "time": time.time(),
+            "output": base_path + self.ext,
+            "seed": annotation.get("seed"),
+            "error": repr(error),
+            "traceback": format_error(error),
+        }
+        try:
+            with open(self.failures, "a") as h:
+                h.write(json.dumps(failure) + "\n")
+        except (IOError, OSError):
+            traceback.print_exc()
+
+    def report(self):
+        """ encoding stats for the codec in use, suitable for a status line """
+        with self.lock:
+            summary = self.stats.summary()
+            summary["errors"] = self.errors
+        return {"output": {self.codec: summary}}
+
+    def close(self):
+        """ waits for every queued frame to be written """
+        self.pool.shutdown(wait=True)
+
+
+def benchmark(im, options, directory, repeat=3):
+    """ encodes im with every codec, returning each codec's stats, so we can
+    pick the best size to encode time tradeoff for a kind of frame """
+    results = OrderedDict()
+    for codec, (ext, encode) in CODECS.items():
+        stats = CodecStats()
+        path = os.path.join(directory, "benchmark" + ext)
+        try:
+            for _ in range(repeat):
+                start = time.time()
+                encode(im, path, options)
+                stats.add(os.path.getsize(path), time.time() - start)
+        # not every pillow build has every codec, webp especially
+        except (IOError, OSError, KeyError) as e:
+            results[codec] = {"error": repr(e)}
+            continue
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+        results[codec] = stats.summary()
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(prog="output.py",
+            description="Compare the output codecs on a rendered frame")
+    parser.add_argument("frame", help="A rendered frame to encode")
+    parser.add_argument("--png-level", metavar="0-9", default=6, type=int)
+    parser.add_argument("--jpeg-quality", metavar="1-100", default=95,
+            type=int)
+    parser.add_argument("-r", "--repeat", metavar="NUM", default=3, type=int)
+    ns = parser.parse_args(sys.argv[1:])
+
+    im = Image.open(ns.frame).convert("L")
+    directory = tempfile.mkdtemp()
+    try:
+        results = benchmark(im, ns, directory, ns.repeat)
+    finally:
+        os.rmdir(directory)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,152 @@
+""" progress reporting for long runs.  a ProgressReporter keeps rolling
+timings of frames and of the stages that make them up, and periodically writes
+them out as one json object per line, so something watching a run can tell how
+fast it's going and whether it's slowing down """
+
+import sys
+import os
+import time
+import json
+import threading
+import resource
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+
+# how many of the most recent frames and stage timings our rates and averages
+# are computed over
+WINDOW = 20
+
+
+@contextmanager
+def no_stage(name):
+    """ stands in for ProgressReporter.stage when nothing is being reported """
+    yield
+
+
+def rss_mb():
+    """ the current resident memory of this process.  /proc only exists on
+    linux, so elsewhere we settle for the peak """
+    try:
+        with open("/proc/self/statm", "r") as h:
+            pages = int(h.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (IOError, OSError):
+        return max_rss_mb()
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on linux, but bytes on mac
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024.0
+    return rss / 1024.0
+
+
+class ProgressReporter(object):
+    """ tracks the progress of a run of `total` frames.  `out` is a path to
+    append status lines to, or None for stdout.  `extra` is an optional
+    function returning a dict of anything else worth reporting """
+
+    def __init__(self, total, out=None, interval=10.0, window=WINDOW,
+            extra=None):
+        self.total = total
+        self.out = out
+        self.interval = interval
+        self.window = window
+        self.extra = extra
+
+        # frames are done once they're written, which the frame writer tells
+        # us about from a background thread
+        self.lock = threading.Lock()
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+
+        self.start = time.time()
+        self.last_emit = self.start
+        self.frame_times = deque([self.start], maxlen=window+1)
+        self.stage_times = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """ times the wrapped block as one run of the named stage """
+        start = time.time()
+        try:
+            yield
+        finally:
+            times = self.stage_times.get(name)
+            if times is None:
+                times = self.stage_times[name] = deque(maxlen=self.window)
+            times.append(time.time() - start)
+
+    def frames_done(self, num=1):
+        now = time.time()
+        with self.lock:
+            self.done += num
+            for _ in range(num):
+                self.frame_times.append(now)
+
+    def frames_skipped(self, num=1):
+        self.skipped += num
+
+    def frame_failed(self):
+        self.failed += 1
+
+    def fps(self):
+        """ the rate of the last `window` frames """
+        if len(self.frame_times) < 2:
+            return 0.0
+        elapsed = self.frame_times[-1] - self.frame_times[0]
+        if elapsed <= 0:
+            return 0.0
+        return (len(self.frame_times) - 1) / elapsed
+
+    def status(self):
+        now = time.time()
+        fps = self.fps()
+        # skipped views are replaced, so they don't count toward the total
+        remaining = max(self.total - self.done, 0)
+
+        eta = None
+        if fps:
+            eta = remaining / fps
+
+        stages = OrderedDict()
+        for name, times in self.stage_times.items():
+            stages[name] = sum(times) / len(times)
+
+        status = OrderedDict([
+            ("time", now),
+            ("elapsed", now - self.start),
+            ("total", self.total),
+            ("done", self.done),
+            ("skipped", self.skipped),
+            ("failed", self.failed),
+            ("percent", 100.0 * (self.total - remaining) / max(self.total, 1)),
+            ("fps", fps),
+            ("eta", eta),
+            ("stages", stages),
+            ("rss_mb", rss_mb()),
+            ("max_rss_mb", max_rss_mb()),
+        ])
+        if self.extra:
+            status.update(self.extra())
+        return status
+
+    def emit(self):
+        """ writes out a status line now """
+        self.last_emit = time.time()
+        line = json.dumps(self.status()) + "\n"
+        if self.out is None:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        else:
+            with open(self.out, "a") as h:
+                h.write(line)
+
+    def maybe_emit(self):
+        """ writes out a status line if it's been `interval` seconds since the
+        last one """
+        if time.time() - self.last_emit >= self.interval:
+            self.emit()
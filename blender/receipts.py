@@ -1,16 +1,20 @@
 import os
 import sys
 from os.path import join, basename, expanduser, exists
-from collections import defaultdict as dd
+from collections import defaultdict as dd, namedtuple, OrderedDict
 import argparse
 from uuid import uuid4
 import json
-from math import radians, pi, sqrt, inf, ceil
+from math import radians, pi, ceil
+from functools import lru_cache
 import random
 from random import uniform, triangular
 import tempfile
+import time
+import traceback
 from scipy.spatial import KDTree
 from PIL import Image
+import numpy as np
 
 import bpy
 from bpy_extras.object_utils import world_to_camera_view
@@ -23,6 +27,14 @@ if THIS_DIR not in sys.path:
     sys.path.insert(0, THIS_DIR)
 
 import text_gen
+import texture_bank
+import scans
+import bb_filter
+import progress
+import output
+import glyphs
+import glyph_balance
+import degrade
 import utils
 
 
@@ -30,8 +42,24 @@ C = bpy.context
 D = bpy.data
 
 TABLE_DIR = "//tables"
+RECEIPT_DIR = "//receipts"
 FONT_DIR = "//fonts/ttfs"
 FLASH_BRIGHTNESS = 1000
+# textures only pass through a png on their way into blender, so we'd rather
+# write them fast than small
+UPLOAD_PNG_LEVEL = 1
+
+
+# what a view needs before we'll spend a render on it: the number of usable
+# glyph bounding boxes, the fraction of the receipt's bounding box inside the
+# frame, and the estimated average height of a glyph in pixels.  attempts is how
+# many times we reshuffle the camera and lighting trying to meet these
+ViewLimits = namedtuple("ViewLimits",
+        "min_bbs min_visible min_glyph_px attempts")
+NO_VIEW_LIMITS = ViewLimits(0, 0, 0, 1)
+# skipped views are replaced with views of new scenes, until this many scenes in
+# a row haven't made a single frame
+MAX_BARREN_SCENES = 50
 
 
 # max offsets for translated sub-windows of a letter's bounding boxes, in
@@ -56,6 +84,13 @@ crumpler = D.objects["crumple mapper"]
 receipt_mat = D.materials["receipt paper"]
 primary_light = D.objects["Lamp"]
 
+# the receipt's subdivisions, which level of detail control scales down from
+# whatever the .blend ships with, and never above it.  each level of each of
+# them halves the receipt's edges, so it's their total level that matters
+subsurfs = [mod for mod in receipt.modifiers if mod.type == "SUBSURF"]
+SUBSURF_LEVELS = [(mod.levels, mod.render_levels) for mod in subsurfs]
+FULL_LOD = sum(render_levels for _, render_levels in SUBSURF_LEVELS)
+
 
 
 def z_to_floor(ob):
@@ -81,8 +116,10 @@ def load_random_table():
     name = random.choice(os.listdir(bpy.path.abspath(TABLE_DIR)))
     return load_table(name)
 
-def shuffle():
-    """ perform the randomization of scene attributes """
+def shuffle_receipt():
+    """ randomize the receipt and its surroundings.  this is everything that
+    changes the shape of the receipt mesh, so it must be redone for every new
+    scene """
 
     # curvature of receipt
     receipt.modifiers["SimpleDeform"].angle = radians(uniform(-90, 90))
@@ -105,15 +142,35 @@ def shuffle():
     # align receipt to floor
     receipt_handle.location.z = z_to_floor(receipt)
     
-    # is our camera flash on?
-    flash.data.node_tree.nodes["Emission"].inputs[1].default_value =\
-        round(uniform(0, 1)) * FLASH_BRIGHTNESS
-        
     # load a random table texture
     table_mat.node_tree.nodes["Texture"].image = load_random_table()
 
+    # some basic receipt texture parameters, controlling glossiness and ink
+    # fadedness
+    nodes = receipt_mat.node_tree.nodes
+    nodes["Glossy BSDF"].inputs[1].default_value = uniform(.15, .5)
+    nodes["Layer Weight"].inputs[0].default_value = uniform(0, .75)
+    #nodes["Math"].inputs[1].default_value = triangular(0, .2, 0)
+    nodes["Math"].inputs[1].default_value = 0
+
+
+def flash_strength():
+    return flash.data.node_tree.nodes["Emission"].inputs[1]
+
+
+def ambient_strength():
+    return world_mat.node_tree.nodes["Background"].inputs[1]
+
+
+def shuffle_view():
+    """ randomize the camera and lighting.  none of these touch the receipt
+    mesh, so we can call this several times for a single prepared scene """
+
+    # is our camera flash on?
+    flash_strength().default_value = round(uniform(0, 1)) * FLASH_BRIGHTNESS
+        
     # adjust the ambient brightness of our HDRI world
-    world_mat.node_tree.nodes["Background"].inputs[1].default_value = uniform(0, 1)
+    ambient_strength().default_value = uniform(0, 1)
     
     # adjust the camera position
     camera.location = Vector((
@@ -131,15 +188,6 @@ def shuffle():
     
     scene.cycles.film_exposure = triangular(0.2, 2, 0)
 
-    
-    # some basic receipt texture parameters, controlling glossiness and ink
-    # fadedness
-    nodes = receipt_mat.node_tree.nodes
-    nodes["Glossy BSDF"].inputs[1].default_value = uniform(.15, .5)
-    nodes["Layer Weight"].inputs[0].default_value = uniform(0, .75)
-    #nodes["Math"].inputs[1].default_value = triangular(0, .2, 0)
-    nodes["Math"].inputs[1].default_value = 0
-    
     # adjust the position of the primary lamp
     loc = Vector((
         uniform(-10, 10),
@@ -148,6 +196,10 @@ def shuffle():
     ))
     primary_light.location = loc
 
+    # the camera tracks its target, so its world matrix is stale until the
+    # scene is updated.  we need it to be correct for projecting bounding boxes
+    C.scene.update()
+
 
 def parse_render_size(s):
     w, h = s.split("x")
@@ -198,13 +250,84 @@ def to_mesh(ctx, scene, ob):
 
 
 
-def generate_receipt_texture(receipt, width, font_dir, line_spacing, kerning):
-    tex_width, tex_height = get_texture_size_from_ob(receipt, width)
-    receipt_im, bbs, font_used = text_gen.gen_receipt(font_dir, (tex_width,
-        tex_height), 45, 0.04, line_spacing, kerning)
+def upload_image(im, name=None):
+    """ hands a PIL image over to blender through a temp png, because
+    blender's own png loader is much faster than filling in an image's pixels
+    from python """
     receipt_file = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-    receipt_im.save(receipt_file)
-    return receipt_file, bbs, font_used
+    try:
+        im.save(receipt_file, "png", compress_level=UPLOAD_PNG_LEVEL)
+        receipt_file.close()
+
+        # packing pulls the pixels into the blend data, so the temp file can go
+        img = load_image(receipt_file.name)
+        img.pack()
+    finally:
+        os.unlink(receipt_file.name)
+
+    if name:
+        img.name = name
+    return img
+
+
+def synthetic_texture(tex_size, glyph_probs=None):
+    """ generates a brand new receipt texture with text_gen """
+    font_dir = bpy.path.abspath(FONT_DIR)
+    line_spacing, kerning = text_gen.random_layout()
+    receipt_im, bbs, font_used = text_gen.gen_receipt(font_dir, tex_size,
+            text_gen.RECEIPT_FONT_SIZE, text_gen.RECEIPT_PADDING, line_spacing,
+            kerning, glyph_probs)
+    return upload_image(receipt_im), bbs, font_used
+
+
+def make_balanced_texture_fn(balancer):
+    """ makes a texture function that generates textures whose glyphs are
+    biased toward the classes balancer says we're short of """
+    def fn(tex_size):
+        return synthetic_texture(tex_size, balancer.probs)
+    return fn
+
+
+def check_bank_size(bank, tex_size):
+    """ a bank built for a differently shaped receipt would get stretched
+    across the mesh, so we refuse it rather than produce skewed glyphs.
+    returns why the bank doesn't fit, or None if it does """
+    bank_w, bank_h = bank.size
+    if abs(bank_h/bank_w - tex_size[1]/tex_size[0]) > 0.01:
+        return ("texture bank size %dx%d doesn't match the receipt's aspect "
+                "ratio, expected something like %dx%d"
+                % (bank_w, bank_h, tex_size[0], tex_size[1]))
+    return None
+
+
+def make_bank_texture_fn(bank):
+    """ makes a texture function that samples from a texture_bank.TextureBank
+    instead of generating new textures.  the bank should already have passed
+    check_bank_size """
+    def fn(tex_size):
+        pixels, bbs, font_used = bank.sample()
+        img = upload_image(Image.fromarray(pixels, "L"), "receipt bank texture")
+        return img, bbs, font_used
+    return fn
+
+
+def make_scan_texture_fn(scan_dir):
+    """ makes a texture function that uses real receipt scans.  each scan is
+    decoded and uploaded to a blender image only once, and that image is kept
+    around for every scene that uses the scan """
+    def upload(path, pixels):
+        img = upload_image(Image.fromarray(pixels, "L"), basename(path))
+        # a fake user marks the image as one that render shouldn't remove
+        img.use_fake_user = True
+        return img
+
+    # scans are padded to the receipt's shape rather than stretched across it
+    dims = get_unmodified_size(receipt)
+    library = scans.ScanLibrary(scan_dir, upload, dims.y / dims.x)
+
+    def fn(tex_size):
+        return library.sample()
+    return fn
 
 
 def triangle_area(verts):
@@ -266,12 +389,16 @@ def norm_img_to_render_space(render_size, coord):
     return coord
 
 
-def map_coord(scene, camera, local_world_mat, uv_coord, mesh,
-        vert_to_coords, vert_to_faces, verts_and_coords, kdtree):
-    """ converts a uv coord to a *NORMALIZED* image-space position """
+def map_uv_to_local(uv_coord, mesh, vert_to_coords, vert_to_faces,
+        verts_and_coords, kdtree):
+    """ converts a uv coord to a position in the mesh's local space, or None if
+    no face contains it.  this only depends on the deformed mesh, not the
+    camera """
 
     fidx = get_containing_face(mesh, vert_to_coords, vert_to_faces,
             verts_and_coords, kdtree, uv_coord)
+    if fidx is None:
+        return None
     face = mesh.tessfaces[fidx]
 
     face_uv_coords = [vert_to_coords[vidx] for vidx in face.vertices]
@@ -279,66 +406,24 @@ def map_coord(scene, camera, local_world_mat, uv_coord, mesh,
 
     bary = barycentric_coords(face_uv_coords, uv_coord)
     uv_local_coord = bary_interpolate(bary, face_coords)
+    return uv_local_coord
+
 
-    wpos = local_world_mat * uv_local_coord
+def map_coord(scene, camera, local_world_mat, local_coord):
+    """ converts a mesh-local coord to a *NORMALIZED* image-space position """
+    wpos = local_world_mat * local_coord
     img_pos = world_to_camera_view(scene, camera, wpos)
     return img_pos
 
 
-def bounding_box_for_points(points):
-    """ for some transformed bounding box points (non right angles), get a
-    bounding box with right angles """
-
-    min_x = inf
-    min_y = inf
-    max_x = 0
-    max_y = 0
-    for point in points:
-        if point[0] < min_x:
-            min_x = point[0]
-
-        if point[1] < min_y:
-            min_y = point[1]
-
-        if point[0] > max_x:
-            max_x = point[0]
-
-        if point[1] > max_y:
-            max_y = point[1]
-
-    return ((min_x, max_y), (max_x, min_y))
-
-
-
-def set_receipt_image(receipt_mat, filename):
-    img = bpy.data.images.load(filename)
-    receipt_image = D.images[basename(filename)]
+def set_receipt_image(receipt_mat, img):
     nodes = receipt_mat.node_tree.nodes
-    nodes["Image Texture"].image = receipt_image
-
-
-def random_float(start, end):
-    return (random.random() * (end - start)) + start
+    nodes["Image Texture"].image = img
 
 
-def generate_bbs(render_size):
-    font_dir = bpy.path.abspath(FONT_DIR)
-
-    line_spacing = random_float(0.9, 1.1)
-    kerning = random_float(0.95, 1.05)
-    receipt_file, letter_bbs, font_used = generate_receipt_texture(receipt,
-            render_size[0], font_dir, line_spacing, kerning)
-
-    receipt_name = receipt_file.name
-
-    set_receipt_image(receipt_mat, receipt_name)
-
-    shuffle()
-    mesh = to_mesh(C, C.scene, receipt)
-
-
-    # do some preprocessing and create some data structures that will aid in our
-    # get_containing_face function
+def build_uv_lookup(mesh):
+    """ do some preprocessing and create some data structures that will aid in
+    our get_containing_face function """
     vert_to_coords = {}
     vert_to_faces = dd(list)
     verts_and_coords = []
@@ -346,7 +431,6 @@ def generate_bbs(render_size):
     for faceidx, face in enumerate(uv_map.data):
         verts = mesh.tessfaces[faceidx].vertices
         for vidx, uv_data in zip(verts, face.uv):
-            vert = mesh.vertices[vidx]
             coord = Vector((uv_data[0], uv_data[1]))
             vert_to_coords[vidx] = coord
 
@@ -354,15 +438,50 @@ def generate_bbs(render_size):
             vert_to_faces[vidx].append(faceidx)
     data = [(coord.x, coord.y) for _, coord in verts_and_coords]
     kdtree = KDTree(data)
+    return vert_to_coords, vert_to_faces, verts_and_coords, kdtree
+
+
+def prepare_scene(texture):
+    """ puts the receipt texture on the receipt and randomizes its shape """
+    set_receipt_image(receipt_mat, texture)
 
-    # loop through our letters and bounding boxes and put the bounding box into
-    # image space
-    image_bbs = []
+    # the last scene may have lowered the subdivision, and shuffle_receipt
+    # puts the receipt on the floor with whatever subdivision is set
+    for mod, (levels, render_levels) in zip(subsurfs, SUBSURF_LEVELS):
+        mod.levels = levels
+        mod.render_levels = render_levels
+    shuffle_receipt()
+
+
+def map_scene(letter_bbs, font_used):
+    """ maps the corners of every glyph onto the deformed receipt mesh.
+    nothing here depends on the camera, so the result can be projected for any
+    number of views.  returns the mapped glyphs and the number of glyphs that
+    couldn't be mapped """
+    mesh = to_mesh(C, C.scene, receipt)
+    try:
+        return map_glyphs(mesh, letter_bbs, font_used)
+    finally:
+        D.meshes.remove(mesh, do_unlink=True)
+
+
+def map_glyphs(mesh, letter_bbs, font_used):
+    """ maps the texture-space corners of every glyph to the mesh's local
+    space, and labels each glyph with what it looks like in font_used.  a
+    glyph with a corner that no face contains is left out, and counted in the
+    number of unmapped glyphs returned along with the mapped ones """
+    lookup = build_uv_lookup(mesh)
+    labels = glyphs.get_label_table(font_used)
+
+    # the face lookup is the expensive part of mapping a glyph, so we do it
+    # once here and keep the mesh-local corners around for every view
+    glyph_quads = []
+    unmapped = 0
     for letter, bbs in letter_bbs.items():
         for top_left, bottom_right in bbs:
 
             # these are the four corners of a glyph.  these are in texture-space
-            # and we want their coordinates in rendered-image space
+            # and we want their coordinates in the deformed mesh's space
             top_left = Vector((top_left[0], top_left[1]))
             top_right = Vector((bottom_right[0], top_left[1]))
             bottom_right = Vector((bottom_right[0], bottom_right[1]))
@@ -370,80 +489,351 @@ def generate_bbs(render_size):
             # we want our winding order to be counter clockwise
             coords = [top_left, top_right, bottom_right, bottom_left]
 
-            # for each corner, map it to distorted image space
-            raw_bbs = []
-            for coord in coords:
-                img_pos = map_coord(scene, camera, receipt.matrix_world, coord,
-                        mesh, vert_to_coords, vert_to_faces, verts_and_coords,
-                        kdtree)
-                img_pos = (img_pos.x, img_pos.y)
-                raw_bbs.append(img_pos)
-
-            # now that we have all the corners in image space, find the bounding
-            # box that contains those warped corners, and we'll use that
-            ul, br = bounding_box_for_points(raw_bbs)
-
-            # convert our texture-space coordinates (0,0 in bottom right) to
-            # image-space (0,0 in upper left)
-            ul = norm_img_to_render_space(render_size, ul)
-            br = norm_img_to_render_space(render_size, br)
-            ul, br = (list(ul), list(br))
-
-
-            width = abs(ul[0] - br[0])
-            height = abs(ul[1] - br[1])
-            ratio = width / height
-
-            if ratio > 3 or ratio < 1/15.0:
+            local_coords = [map_uv_to_local(coord, mesh, *lookup) for coord in
+                    coords]
+            if None in local_coords:
+                unmapped += 1
                 continue
+            glyph_quads.append((labels.get(letter, letter), local_coords))
+
+    return glyph_quads, unmapped
+
+
+def project_bbs(render_size, glyph_quads, unmapped=0):
+    """ projects the mesh-local glyph corners from map_scene through the
+    current camera into rendered-image space, and filters out the glyphs that
+    aren't usable from this view.  returns the image bounding boxes and the
+    number of glyphs rejected for each reason, starting with the `unmapped`
+    glyphs that map_scene couldn't place on the mesh """
+    world_mat = receipt.matrix_world
+    letters = []
+    corners = []
+    heights = []
+    for letter, local_coords in glyph_quads:
+        letters.append(letter)
+        for coord in local_coords:
+            img_pos = map_coord(scene, camera, world_mat, coord)
+            corners.append((img_pos.x, img_pos.y, img_pos.z))
+
+        # the glyph's height in world units, which is what depths are in
+        tl, tr, br, bl = (world_mat * coord for coord in local_coords)
+        heights.append(((bl - tl).length + (br - tr).length) / 2.0)
+
+    quads = np.array(corners, dtype=np.float64).reshape(-1, 4, 3)
+    keep, counts = bb_filter.filter_quads(quads, render_size,
+            np.array(heights, dtype=np.float64))
+    rejected = OrderedDict([("unmapped", unmapped)])
+    rejected.update(counts)
+
+    letters = [letter for letter, kept in zip(letters, keep) if kept]
+    raw_bbs = bb_filter.to_render_space(quads[keep], render_size)
+
+    # the warped corners aren't at right angles anymore, so we also keep the
+    # upright bounding box that contains them
+    uls = raw_bbs.min(axis=1)
+    brs = raw_bbs.max(axis=1)
+    sizes = brs - uls
+
+    # the glyph's baseline direction, averaged from its top and bottom edges
+    tl, tr, br, bl = (raw_bbs[:, i] for i in range(4))
+    avg_vecs = (tr - tl) + (br - bl)
+    norm_vecs = avg_vecs / np.linalg.norm(avg_vecs, axis=1)[:, None]
+
+    image_bbs = list(zip(letters, zip(uls.tolist(), brs.tolist()),
+        sizes.tolist(), raw_bbs.tolist(), norm_vecs.tolist()))
+    return image_bbs, rejected
+
+
+def render_still():
+    """ renders the scene as it currently stands and returns it as a grayscale
+    image """
+    rs = scene.render
+    output_path = tempfile.NamedTemporaryFile(suffix=".png", delete=False).name
+    rs.filepath = output_path
 
-            raw_bbs = [norm_img_to_render_space(render_size, bb) for bb in
-                    raw_bbs]
-
-            tl, tr, br, bl = raw_bbs
-            upper = vec_sub(tr, tl)
-            lower = vec_sub(br, bl)
-            avg_vec = vec_add(upper, lower)
-            norm_vec = vec_normalize(avg_vec)
-
-            data = (letter, (ul, br), (width, height), raw_bbs, norm_vec)
-            image_bbs.append(data)
-
-    return image_bbs, receipt_name
+    try:
+        bpy.ops.render.render(write_still=True)
+        im = Image.open(rs.filepath).convert("L")
+    finally:
+        os.unlink(output_path)
+    return im
 
 
-def render(size):
+def render(size, texture_fn, num_views=1, limits=NO_VIEW_LIMITS,
+        lod_edge_px=None, stage=progress.no_stage):
+    """ prepares one receipt scene and renders it from num_views randomized
+    camera and lighting setups.  views that can't be made to meet limits
+    aren't worth rendering, and are skipped.  if lod_edge_px is set, the
+    receipt is subdivided only as finely as it takes for its faces to be that
+    many pixels across in the nearest view.  stage is a context manager
+    factory, like ProgressReporter.stage, used to time each step.  returns a
+    list of (annotation, image) pairs """
     width, height = size
 
     rs = scene.render
     rs.resolution_x = width
     rs.resolution_y = height
 
-    image_bbs, texture_file = generate_bbs(size)
-
-    output_path = tempfile.NamedTemporaryFile(suffix=".png", delete=False).name
-    rs.filepath = output_path
-
-    bpy.ops.render.render(write_still=True)
-    im = Image.open(rs.filepath).convert("L")
-
-    os.unlink(texture_file)
-    os.unlink(output_path)
-
-    return image_bbs, im
+    tex_size = get_texture_size_from_ob(receipt, width)
+    with stage("texture"):
+        texture, letter_bbs, font_used = texture_fn(tex_size)
 
+    try:
+        with stage("prepare"):
+            prepare_scene(texture)
+
+        # we pick every view's camera before evaluating the mesh, because the
+        # views decide how finely the mesh needs to be subdivided
+        with stage("plan"):
+            glyph_height = mean_glyph_height(letter_bbs)
+            plans = plan_views(size, glyph_height, num_views, limits)
+        if not plans:
+            return []
+
+        lod = None
+        if lod_edge_px:
+            lod = apply_lod(size, [view for view, _ in plans], lod_edge_px)
+            plans = recheck_views(size, glyph_height, plans, limits)
+            if not plans:
+                return []
+
+        with stage("map"):
+            glyph_quads, unmapped = map_scene(letter_bbs, font_used)
+        return render_views(size, glyph_quads, unmapped, plans, font_used, lod,
+                limits, stage)
+    finally:
+        # most scenes get a new texture, so drop the old one rather than
+        # letting the image datablocks pile up
+        if not texture.use_fake_user:
+            D.images.remove(texture, do_unlink=True)
+
+
+def mean_glyph_height(letter_bbs):
+    """ the average height of the texture's glyphs, as a fraction of the
+    texture's height """
+    heights = [top_left[1] - bottom_right[1] for bbs in letter_bbs.values()
+            for top_left, bottom_right in bbs]
+    if not heights:
+        return 0.0
+    return sum(heights) / len(heights)
+
+
+def view_coverage(render_size, glyph_height):
+    """ a quick look at how well the camera sees the receipt, without mapping
+    any glyphs.  returns the fraction of the receipt's projected bounding box
+    that lands inside the frame, and an estimate of the average glyph height in
+    pixels """
+    world_mat = receipt.matrix_world
+    bb = [Vector(corner) for corner in receipt.bound_box]
+    projected = [world_to_camera_view(scene, camera, world_mat * corner)
+            for corner in bb]
+
+    # anything behind the camera projects to nonsense
+    if any(p.z <= 0 for p in projected):
+        return 0.0, 0.0
+
+    min_x = min(p.x for p in projected)
+    max_x = max(p.x for p in projected)
+    min_y = min(p.y for p in projected)
+    max_y = max(p.y for p in projected)
+    area = (max_x - min_x) * (max_y - min_y)
+    if area <= 0:
+        return 0.0, 0.0
+
+    visible_w = max(min(max_x, 1.0) - max(min_x, 0.0), 0.0)
+    visible_h = max(min(max_y, 1.0) - max(min_y, 0.0), 0.0)
+    visible = visible_w * visible_h / area
+
+    # the texture's height runs along the receipt's local y axis, so the
+    # projected length of that axis through the receipt's middle tells us how
+    # many pixels the texture's height covers
+    mins = Vector([min(c[i] for c in bb) for i in range(3)])
+    maxs = Vector([max(c[i] for c in bb) for i in range(3)])
+    middle = (mins + maxs) / 2.0
+    ends = []
+    for y in (mins.y, maxs.y):
+        end = world_to_camera_view(scene, camera,
+                world_mat * Vector((middle.x, y, maxs.z)))
+        ends.append(Vector(norm_img_to_render_space(render_size, end)))
+    receipt_px = (ends[1] - ends[0]).length
+
+    return visible, glyph_height * receipt_px
+
+
+def view_usable(render_size, glyph_height, limits):
+    """ whether the current camera sees enough of the receipt, close enough,
+    to meet limits """
+    visible, glyph_px = view_coverage(render_size, glyph_height)
+    return visible >= limits.min_visible and glyph_px >= limits.min_glyph_px
+
+
+def shuffle_usable_view(render_size, glyph_height, limits):
+    """ reshuffles the camera and lighting until the receipt is in view enough,
+    and close enough, to meet limits.  returns the number of attempts it took,
+    or None if it never did """
+    for attempt in range(1, limits.attempts + 1):
+        shuffle_view()
+        if view_usable(render_size, glyph_height, limits):
+            return attempt
+    return None
+
+
+@lru_cache(maxsize=None)
+def base_edge_length():
+    """ the average edge length of the receipt's mesh before subdivision, in
+    world units """
+    mesh = receipt.data
+    scale = receipt.matrix_world.to_scale()
+    total = 0.0
+    for edge in mesh.edges:
+        v1, v2 = (mesh.vertices[vidx].co for vidx in edge.vertices)
+        diff = v1 - v2
+        total += Vector((diff.x*scale.x, diff.y*scale.y, diff.z*scale.z)).length
+    return total / len(mesh.edges)
+
+
+def focal_length_px(render_size):
+    """ the camera's focal length in pixels of the rendered image """
+    cam = camera.data
+    width, height = render_size
+    if cam.sensor_fit == "VERTICAL":
+        return cam.lens / cam.sensor_height * height
+    if cam.sensor_fit == "HORIZONTAL":
+        return cam.lens / cam.sensor_width * width
+    return cam.lens / cam.sensor_width * max(width, height)
+
+
+def apply_lod(render_size, views, edge_px):
+    """ subdivides the receipt only as finely as it takes for its faces to be
+    at most edge_px pixels across in the nearest of views, and puts it back on
+    the floor, since its extent changes with the subdivision.  glyphs are
+    mapped onto the same mesh that gets rendered, so their boxes stay exact.
+    what a lower level loses is the finer wrinkles of the displacement, which
+    the face size doesn't measure.  returns the levels used and the
+    approximate projected face size """
+    if not subsurfs:
+        return None
+
+    # the nearest part of the receipt can be up to half its bounding box closer
+    # than its middle
+    world_mat = receipt.matrix_world
+    corners = [world_mat * Vector(corner) for corner in receipt.bound_box]
+    center = sum(corners, Vector()) / len(corners)
+    radius = max((corner - center).length for corner in corners)
+    nearest = min((view[2] - center).length for view in views)
+    nearest = max(nearest - radius, 0.1)
+
+    base_px = base_edge_length() * focal_length_px(render_size) / nearest
+    level = 0
+    while level < FULL_LOD and base_px / 2**level > edge_px:
+        level += 1
+
+    set_lod(level)
+    C.scene.update()
+    receipt_handle.location.z = z_to_floor(receipt)
+    C.scene.update()
 
-def vec_sub(a, b):
-    return (a[0]-b[0], a[1]-b[1])
+    return {
+        "level": level,
+        "full_level": FULL_LOD,
+        "face_px": base_px / 2**level,
+    }
+
+
+def set_lod(level):
+    """ spreads a total subdivision level over the receipt's subdivisions, in
+    stack order, without raising any of them above the .blend's level """
+    remaining = level
+    for mod, (_, full) in zip(subsurfs, SUBSURF_LEVELS):
+        mod_level = min(full, remaining)
+        remaining -= mod_level
+
+        # the same level for the viewport and for rendering, since to_mesh
+        # evaluates the mesh with the viewport's and cycles renders with the
+        # other
+        mod.levels = mod_level
+        mod.render_levels = mod_level
+
+
+def capture_view():
+    """ the camera and lighting that shuffle_view picked, so that a view can be
+    planned now and rendered later """
+    return (
+        flash_strength().default_value,
+        ambient_strength().default_value,
+        camera.location.copy(),
+        cam_target.location.z,
+        camera.data.cycles.aperture_size,
+        scene.cycles.film_exposure,
+        primary_light.location.copy(),
+    )
 
-def vec_add(a, b):
-    return (a[0]+b[0], a[1]+b[1])
 
-def vec_normalize(v):
-    norm = sqrt(v[0]*v[0] + v[1]*v[1])
-    return (v[0]/norm, v[1]/norm)
+def restore_view(view):
+    """ puts back a view from capture_view """
+    (flash_strength().default_value, ambient_strength().default_value,
+        camera.location, cam_target.location.z,
+        camera.data.cycles.aperture_size, scene.cycles.film_exposure,
+        primary_light.location) = view
+    C.scene.update()
 
 
+def plan_views(size, glyph_height, num_views, limits):
+    """ picks the camera and lighting of up to num_views views.  returns a list
+    of (view, attempts) pairs, with views from capture_view """
+    plans = []
+    for _ in range(num_views):
+        attempts = shuffle_usable_view(size, glyph_height, limits)
+        if attempts is None:
+            print("skipping view, no camera placement in %d attempts "
+                    "showed enough of the receipt" % limits.attempts,
+                    file=sys.stderr)
+            continue
+        plans.append((capture_view(), attempts))
+    return plans
+
+
+def recheck_views(render_size, glyph_height, plans, limits):
+    """ drops the planned views that no longer meet limits now that the
+    receipt's subdivision, and with it the receipt, has changed """
+    kept = []
+    for view, attempts in plans:
+        restore_view(view)
+        if view_usable(render_size, glyph_height, limits):
+            kept.append((view, attempts))
+        else:
+            print("skipping view, it no longer shows enough of the receipt "
+                    "at its level of detail", file=sys.stderr)
+    return kept
+
+
+def render_views(size, glyph_quads, unmapped, plans, font_used, lod, limits,
+        stage):
+    """ renders the planned views of a prepared scene """
+    views = []
+    for view, attempts in plans:
+        with stage("project"):
+            restore_view(view)
+            image_bbs, rejected = project_bbs(size, glyph_quads, unmapped)
+
+        if len(image_bbs) < limits.min_bbs:
+            print("skipping view with %d usable glyphs, rejected: %s"
+                    % (len(image_bbs), json.dumps(rejected)),
+                    file=sys.stderr)
+            continue
+
+        annotation = {
+            "bbs": image_bbs,
+            "rejected": rejected,
+            "font": font_used,
+            "view_attempts": attempts,
+            "lod": lod,
+        }
+        with stage("render"):
+            im = render_still()
+        views.append((annotation, im))
+
+    return views
 
 
 def get_arg_str():
@@ -459,10 +849,96 @@ def get_arg_str():
     return arg_str
 
 
-def progress_run(fn, num):
-    for i in range(num):
-        print(100*i/num)
-        fn()
+def scene_params():
+    """ a snapshot of the randomized scene attributes, for figuring out what
+    went wrong with a frame """
+    table_image = table_mat.node_tree.nodes["Texture"].image
+    return {
+        "curvature": receipt.modifiers["SimpleDeform"].angle,
+        "wrinkliness": receipt.modifiers["Displace"].strength,
+        "crumple_scale": crumpler.scale.x,
+        "crumple_rotation": list(crumpler.rotation_euler),
+        "receipt_rotation": receipt.rotation_euler.z,
+        "table": table_image.name if table_image else None,
+        "flash": flash_strength().default_value,
+        "ambient": ambient_strength().default_value,
+        "camera": list(camera.location),
+        "cam_target_z": cam_target.location.z,
+        "aperture_size": camera.data.cycles.aperture_size,
+        "film_exposure": scene.cycles.film_exposure,
+        "lamp": list(primary_light.location),
+    }
+
+
+def record_failure(manifest, seed, attempt, gave_up):
+    """ appends the failure currently being handled to the manifest, as one json
+    object per line """
+    try:
+        params = scene_params()
+    except Exception:
+        params = None
+
+    failure = {
+        "time": time.time(),
+        "seed": seed,
+        "attempt": attempt,
+        "gave_up": gave_up,
+        "error": repr(sys.exc_info()[1]),
+        "traceback": traceback.format_exc(),
+        "params": params,
+    }
+    with open(manifest, "a") as h:
+        h.write(json.dumps(failure) + "\n")
+
+
+def progress_run(fn, total, max_views, reporter, seeds, retries, manifest):
+    """ calls fn(num_views, seed) for scene after scene, until they've made
+    total frames.  fn returns how many frames its scene made, which is fewer
+    than num_views when views get skipped, so the missing frames are made up
+    by later scenes.  every attempt gets a fresh seed for the random module,
+    drawn from seeds, so that a failed scene can be retried with new
+    randomness, up to `retries` times, and reproduced later from its logged
+    seed.  failures are appended to the manifest file.  returns the number of
+    frames made """
+    reporter.emit()
+    made = 0
+    barren = 0
+    while made < total:
+        num_views = min(max_views, total - made)
+        scene_made = 0
+        for attempt in range(retries + 1):
+            seed = seeds.getrandbits(32)
+            random.seed(seed)
+            try:
+                scene_made = fn(num_views, seed)
+                break
+            except Exception:
+                gave_up = attempt == retries
+                traceback.print_exc()
+                record_failure(manifest, seed, attempt, gave_up)
+                reporter.frame_failed()
+
+        made += scene_made
+        reporter.maybe_emit()
+
+        # settings that no scene can meet would otherwise keep us going forever
+        barren = 0 if scene_made else barren + 1
+        if barren >= MAX_BARREN_SCENES:
+            print("giving up after %d scenes in a row made no frames"
+                    % barren, file=sys.stderr)
+            break
+
+    reporter.emit()
+    return made
+
+
+def datablock_counts():
+    """ blender keeps loaded data around, so a growing count here is a good
+    sign of a leak slowing the run down """
+    return {
+        "images": len(D.images),
+        "meshes": len(D.meshes),
+    }
 
 
 
@@ -471,28 +947,161 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="generate_receipts.sh")
     parser.add_argument("-f", "--frames", metavar="NUM", default=1, type=int,
             action="store", help="The number of frames to render")
+    parser.add_argument("-v", "--views", metavar="NUM", default=1, type=int,
+            action="store", help="The number of camera views to render of "
+            "each prepared receipt scene")
     parser.add_argument("--seed", type=int, default=None)
     parser.add_argument("-s", "--size", metavar="WxH", default="1440x2560",
             action="store", help="Size of the rendered output",
             type=parse_render_size)
+    textures = parser.add_mutually_exclusive_group()
+    textures.add_argument("--texture-bank", metavar="DIR", default=None,
+            help="Sample receipt textures from a bank built with "
+            "texture_bank.py instead of generating them")
+    textures.add_argument("--scans", action="store_true",
+            help="Use the real receipt scans, and their glyph box sidecars, "
+            "from the receipts directory instead of generating textures")
+    textures.add_argument("--balance", action="store_true",
+            help="Bias generated text toward the glyph classes we've emitted "
+            "the fewest labels for")
+    parser.add_argument("--balance-counts", metavar="FILE", default=None,
+            help="A json file of per-class label counts, shared by every "
+            "worker balancing glyphs")
+    parser.add_argument("--balance-target", metavar="FILE", default=None,
+            help="A json mapping of glyph class to relative weight to balance "
+            "toward, instead of all classes equally")
+    parser.add_argument("--balance-strength", metavar="NUM", default=1.0,
+            type=float, help="How hard to push toward the balance target")
+    parser.add_argument("--bank-reuse", metavar="NUM", default=1, type=int,
+            help="How many scenes each bank texture may be used for")
+    parser.add_argument("--lod", metavar="PX", default=None, type=float,
+            help="Subdivide the receipt only as finely as it takes for its "
+            "faces to be this many pixels across in the nearest view")
+    parser.add_argument("--min-bbs", metavar="NUM", default=1, type=int,
+            help="Skip views with fewer usable glyph bounding boxes than this, "
+            "before rendering them")
+    parser.add_argument("--min-visible", metavar="0-1", default=0.75,
+            type=float, help="The fraction of the receipt that must be in "
+            "frame for a camera placement to be used")
+    parser.add_argument("--min-glyph-px", metavar="NUM", default=5.0,
+            type=float, help="The average glyph height, in pixels, that a "
+            "camera placement must reach to be used")
+    parser.add_argument("--view-attempts", metavar="NUM", default=20,
+            type=int, help="How many camera placements to try for each view "
+            "before skipping it")
+    parser.add_argument("--status", metavar="FILE", default=None,
+            help="Append progress as json lines to this file instead of "
+            "stdout")
+    parser.add_argument("--status-interval", metavar="SECONDS", default=10.0,
+            type=float, help="How often to report progress")
+    parser.add_argument("--retries", metavar="NUM", default=3, type=int,
+            help="How many times to retry a failed scene with new randomness "
+            "before giving up on it")
+    parser.add_argument("--codec", default="png", choices=list(output.CODECS),
+            help="How to encode rendered frames")
+    parser.add_argument("--png-level", metavar="0-9", default=6, type=int,
+            help="PNG compression level, lower is faster but bigger")
+    parser.add_argument("--jpeg-quality", metavar="1-100", default=95,
+            type=int, help="JPEG quality")
+    parser.add_argument("--writers", metavar="NUM", default=2, type=int,
+            help="Number of background processes encoding frames")
+    parser.add_argument("--degrade", metavar="NUM", default=0, type=int,
+            help="How many photometrically degraded copies to make of each "
+            "rendered frame")
+    parser.add_argument("--degrade-config", metavar="FILE", default=None,
+            help="A json file overriding the default degradation settings")
     parser.add_argument("--output", required=True)
 
 
     ns = parser.parse_args(get_arg_str())
-    if ns.seed:
-        random.seed(ns.seed)
+
+    # every scene is seeded from this, so a whole run is reproducible from
+    # --seed and a single scene from the seed in its annotation
+    seeds = random.Random(ns.seed)
 
     num_frames = ns.frames
     render_size = ns.size
 
-    def fn():
-        image_bbs, im = render(ns.size)
-        filename = uuid4().hex
-        image_output = join(ns.output, filename + ".png")
-        json_output = join(ns.output, filename + ".json")
-
-        im.save(image_output, "png")
-        with open(json_output, "w") as h:
-            json.dump(image_bbs, h, indent=2)
-
-    progress_run(fn, num_frames)
+    degrade_config = degrade.DEFAULT_CONFIG
+    if ns.degrade_config:
+        degrade_config = degrade.load_config(ns.degrade_config)
+
+    balancer = None
+    texture_fn = synthetic_texture
+    if ns.balance:
+        target = None
+        if ns.balance_target:
+            target = glyph_balance.load_target(ns.balance_target,
+                    glyphs.get_sample_glyphs().replace(" ", ""))
+        balancer = glyph_balance.GlyphBalancer(ns.balance_counts, target,
+                ns.balance_strength)
+        texture_fn = make_balanced_texture_fn(balancer)
+    elif ns.texture_bank:
+        bank = texture_bank.TextureBank(ns.texture_bank, ns.bank_reuse)
+        mismatch = check_bank_size(bank,
+                get_texture_size_from_ob(receipt, render_size[0]))
+        if mismatch:
+            parser.error(mismatch)
+        texture_fn = make_bank_texture_fn(bank)
+    elif ns.scans:
+        texture_fn = make_scan_texture_fn(bpy.path.abspath(RECEIPT_DIR))
+
+    manifest = join(ns.output, "failures.jsonl")
+    writer = output.FrameWriter(ns.codec, ns, ns.writers, failures=manifest)
+
+    def extra_status():
+        status = datablock_counts()
+        status.update(writer.report())
+        return status
+
+    limits = ViewLimits(ns.min_bbs, ns.min_visible, ns.min_glyph_px,
+            ns.view_attempts)
+
+    reporter = progress.ProgressReporter(num_frames, ns.status,
+            ns.status_interval, extra=extra_status)
+
+    def fn(num_views, seed):
+        views = render(ns.size, texture_fn, num_views, limits, ns.lod,
+                reporter.stage)
+        degrade_rng = np.random.RandomState(random.getrandbits(32))
+
+        # degrading doesn't move anything, so the copies keep the original's
+        # annotation, plus what was done to them
+        frames = []
+        for annotation, im in views:
+            annotation["seed"] = seed
+            filename = uuid4().hex
+            with reporter.stage("degrade"):
+                copies = degrade.variants(im, ns.degrade, degrade_rng,
+                        degrade_config)
+
+            frames.append((filename, annotation, im, copies))
+
+        # a failed scene is retried from scratch, so nothing is counted or
+        # written until every view of it has made it this far
+        if balancer:
+            balancer.update(bb[0] for _, annotation, _, _ in frames
+                    for bb in annotation["bbs"])
+
+        reporter.frames_skipped(num_views - len(views))
+        for filename, annotation, im, copies in frames:
+            with reporter.stage("save"):
+                writer.submit(im, annotation, join(ns.output, filename),
+                        reporter.frames_done)
+
+            for copy, params in copies:
+                copy_annotation = dict(annotation, source=filename,
+                        degradation=params)
+                writer.submit(copy, copy_annotation,
+                        join(ns.output, uuid4().hex))
+
+        return len(frames)
+
+    made = progress_run(fn, num_frames, ns.views, reporter, seeds, ns.retries,
+            manifest)
+    if made < num_frames:
+        print("only made %d of %d frames" % (made, num_frames),
+                file=sys.stderr)
+
+    writer.close()
+    reporter.emit()
@@ -0,0 +1,130 @@
+""" real receipt scans, used as receipt textures in place of generated text.
+
+every scan needs a sidecar json file next to it with the same name, for example
+receipt.jpg and receipt.json, holding the glyph boxes that OCR found in it:
+
+    {
+        "font": "optional name of the receipt's font",
+        "glyphs": [
+            {"char": "T", "box": [x1, y1, x2, y2]},
+            ...
+        ]
+    }
+
+boxes are in pixels of the scan, with 0,0 in the upper left, which is what OCR
+tools report.  scans without a sidecar are skipped.
+
+scans come in every shape, and a scan stretched across a differently shaped
+receipt would have skewed glyphs, so scans are padded out with blank paper to
+the receipt's aspect ratio.
+"""
+
+from os.path import join, splitext, exists
+import os
+import sys
+import random
+from collections import defaultdict as dd
+import json
+
+from PIL import Image
+import numpy as np
+
+
+SCAN_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+# the gray level that scans are padded with
+PAPER = 255
+
+
+def sidecar_path(scan_path):
+    return splitext(scan_path)[0] + ".json"
+
+
+def normalize_boxes(glyphs, size):
+    """ converts sidecar pixel boxes into the normalized letter->boxes mapping
+    that text_gen.gen_receipt returns """
+    width, height = size
+    all_bbs = dd(list)
+    for glyph in glyphs:
+        l, u, r, b = glyph["box"]
+        bb = ((l/width, 1.0-u/height), (r/width, 1.0-b/height))
+        all_bbs[glyph["char"]].append(bb)
+    return all_bbs
+
+
+def pad_to_aspect(pixels, glyphs, aspect):
+    """ centers a scan on blank paper whose height over width is aspect, and
+    moves its sidecar glyph boxes along with it """
+    height, width = pixels.shape
+    padded_w = max(width, int(round(height / aspect)))
+    padded_h = max(height, int(round(width * aspect)))
+
+    left = (padded_w - width) // 2
+    top = (padded_h - height) // 2
+    padded = np.full((padded_h, padded_w), PAPER, dtype=np.uint8)
+    padded[top:top+height, left:left+width] = pixels
+
+    moved = []
+    for glyph in glyphs:
+        l, u, r, b = glyph["box"]
+        moved.append(dict(glyph, box=[l+left, u+top, r+left, b+top]))
+    return padded, moved
+
+
+def load_scan(scan_path, aspect=None):
+    """ decodes a scan to a uint8 grayscale array and loads its sidecar,
+    padding both to aspect if it's given.  returns (pixels, letter_bbs,
+    font_used) """
+    with open(sidecar_path(scan_path), "r") as h:
+        sidecar = json.load(h)
+
+    im = Image.open(scan_path).convert("L")
+    pixels = np.asarray(im, dtype=np.uint8)
+    glyphs = sidecar["glyphs"]
+    if aspect:
+        pixels, glyphs = pad_to_aspect(pixels, glyphs, aspect)
+
+    height, width = pixels.shape
+    letter_bbs = normalize_boxes(glyphs, (width, height))
+    return pixels, letter_bbs, sidecar.get("font")
+
+
+def find_scans(scan_dir):
+    """ lists the scans in scan_dir that have a sidecar """
+    scans = []
+    for name in sorted(os.listdir(scan_dir)):
+        path = join(scan_dir, name)
+        if splitext(name)[1].lower() not in SCAN_EXTENSIONS:
+            continue
+
+        if not exists(sidecar_path(path)):
+            print("skipping scan %r, it has no glyph box sidecar" % name,
+                    file=sys.stderr)
+            continue
+
+        scans.append(path)
+    return scans
+
+
+class ScanLibrary(object):
+    """ the scans of a directory, each decoded once on first use, padded to
+    `aspect` (height over width) if it's given, and then kept around in
+    whatever form `prepare` turns the pixels into """
+
+    def __init__(self, scan_dir, prepare=None, aspect=None):
+        self.paths = find_scans(scan_dir)
+        if not self.paths:
+            raise ValueError("no scans with glyph box sidecars in %r"
+                    % scan_dir)
+
+        self.prepare = prepare or (lambda path, pixels: pixels)
+        self.aspect = aspect
+        self._cache = {}
+
+    def sample(self):
+        """ picks a random scan and returns (prepared, letter_bbs, font_used) """
+        path = random.choice(self.paths)
+        if path not in self._cache:
+            pixels, letter_bbs, font_used = load_scan(path, self.aspect)
+            self._cache[path] = (self.prepare(path, pixels), letter_bbs,
+                    font_used)
+        return self._cache[path]
@@ -6,7 +6,9 @@ import os
 import random
 from functools import partial, lru_cache
 from collections import defaultdict as dd
+import numpy as np
 import glyphs
+import font_atlas
 
 
 #THIS_DIR = expanduser("~/workspace/acolyte")
@@ -14,6 +16,10 @@ THIS_DIR = dirname(abspath(__file__))
 FONT_DIR = join(THIS_DIR, "fonts/ttfs")
 BB_PADDING = 0.45
 
+# the font size and padding fraction that receipt textures are generated with
+RECEIPT_FONT_SIZE = 45
+RECEIPT_PADDING = 0.04
+
 FONT_WHITELIST = {
     "BPtypewrite.otf",
     "BPtypewriteDamaged.otf",
@@ -126,40 +132,68 @@ def make_tight_bounder(chars):
     return fn
 
 
-def gen_char():
-    return glyphs.get_glyph()
-
-def gen_word():
-    chars = []
-
-    # ensure the first char is not a space
-    char = " "
-    while char == " ":
-        char = gen_char()
-    chars.append(char)
-
-    while char != " ":
-        char = gen_char()
-        chars.append(char)
-
-    return "".join(chars)
-
-
-def gen_text(sizer, max_width):
-    line = []
-    cur_len = 0
-
-    while True:
-        word = gen_word()
-        cur_len, _ = sizer("".join(line + [word]))
-        if cur_len >= max_width:
-            break
-        line.append(word)
-
-    # remove the trailing space from the last word
-    line[-1] = line[-1].strip()
-
-    return "".join(line)
+class TextGenerator(object):
+    """ generates lines of random words, drawing glyphs a whole block at a time
+    from a numpy RandomState instead of one at a time.  a word is a run of
+    non-space glyphs followed by a single space, and a line is as many words as
+    fit in a width, as measured by the same rules as create_text_sizer """
+
+    def __init__(self, bb_mapping, kerning, rng, probs=None,
+            block_size=4096):
+        self.rng = rng
+        self.probs = probs
+        self.block_size = block_size
+
+        alphabet = glyphs.get_sample_glyphs()
+        self.codes = np.frombuffer(alphabet.encode("ascii"), dtype=np.uint8)
+        self.space = alphabet.index(" ")
+
+        # x2 is where a glyph's content ends.  every glyph but a line's last is
+        # followed by the kerned x2, just like in create_text_sizer
+        self.right = np.array([bb_mapping[g][2] for g in alphabet],
+                dtype=np.float64)
+        self.advance = self.right * kerning
+
+        self._buf = np.empty(0, dtype=np.intp)
+
+    def _fill(self):
+        """ appends another block of glyphs to our buffer, collapsing runs of
+        spaces so that every space ends exactly one word """
+        block = glyphs.sample_glyphs(self.rng, self.block_size, self.probs)
+        buf = np.concatenate([self._buf, block])
+
+        is_space = buf == self.space
+        after_space = np.concatenate([[True], is_space[:-1]])
+        self._buf = buf[~(is_space & after_space)]
+
+    def line(self, max_width):
+        """ returns the next line of text narrower than max_width """
+        while True:
+            ends = np.nonzero(self._buf == self.space)[0]
+
+            # the width of the text up to and including each word.  the last
+            # glyph of each is the word's space, which isn't kerned
+            advances = np.cumsum(self.advance[self._buf])
+            widths = advances[ends] - self.advance[self.space] + \
+                    self.right[self.space]
+
+            too_wide = np.nonzero(widths >= max_width)[0]
+            if not len(too_wide):
+                self._fill()
+                continue
+
+            # a single word wider than the line can never fit, so skip it
+            num_words = too_wide[0]
+            if num_words == 0:
+                self._buf = self._buf[ends[0]+1:]
+                continue
+
+            # the word that didn't fit starts the next line, and we leave off
+            # the trailing space of the last word that did
+            last_space = ends[num_words-1]
+            line = self._buf[:last_space]
+            self._buf = self._buf[last_space+1:]
+            return self.codes[line].tobytes().decode("ascii")
 
 
 def create_text_sizer(bb_mapping, kerning):
@@ -209,28 +243,62 @@ def demo_fonts(font_dir, im_size, font_size):
     return im
 
 
+def random_layout():
+    """ picks a random (line_spacing, kerning) pair for a receipt """
+    line_spacing = random.uniform(0.9, 1.1)
+    kerning = random.uniform(0.95, 1.05)
+    return line_spacing, kerning
+
+
 def gen_receipt(font_dir, im_size, font_size, im_padding,
-        line_spacing, kerning):
+        line_spacing, kerning, glyph_probs=None):
     """
     font_dir is the directory to pick a font from
     im_size is a (width, height) tuple
     font_size is the font size
     im_padding is a fraction from 0-1 repesenting what percentage of the image
     width should be padding
+    glyph_probs is an optional function taking the name of the font picked and
+    returning the probabilities for glyphs.sample_glyphs to draw text with
     """
 
     font_file = pick_font(font_dir)
-    font = load_font(font_file, font_size)
-
-    bounder = make_tight_bounder(glyphs.get_print_glyphs())
+    font_name = basename(font_file)
     width, height = im_size
-    bb_mapping = bounder(font)
 
     image = Image.new("RGB", im_size, (255, 255, 255))
     draw = ImageDraw.Draw(image)
 
+    # with a prebuilt atlas we never have to open the font at all, we just
+    # stamp its glyph masks.  otherwise we rasterize the font ourselves
+    atlas = font_atlas.load_atlas(font_dir, font_size)
+    if atlas and font_name in atlas:
+        bb_mapping = atlas.bb_mapping(font_name)
+        masks = atlas.masks(font_name)
+
+        def draw_glyph(cursor, letter):
+            x, y = int(cursor[0]), int(cursor[1])
+            mask = masks[letter]
+            image.paste((0, 0, 0), (x, y, x + mask.size[0], y + mask.size[1]),
+                    mask)
+    else:
+        font = load_font(font_file, font_size)
+        bounder = make_tight_bounder(glyphs.get_print_glyphs())
+        bb_mapping = bounder(font)
+
+        def draw_glyph(cursor, letter):
+            draw.text(cursor, letter, font=font, fill=(0,0,0))
+
 
     sizer = create_text_sizer(bb_mapping, kerning)
+    # seeded from the random module, so that seeding it still makes receipts
+    # reproducible
+    rng = np.random.RandomState(random.getrandbits(32))
+    probs = None
+    if glyph_probs:
+        probs = glyph_probs(font_name)
+    lines = TextGenerator(bb_mapping, kerning, rng, probs)
+
     max_letter_height = 0
     for glyph in glyphs.get_print_glyphs():
         max_letter_height = max(sizer(glyph)[1], max_letter_height)
@@ -241,7 +309,7 @@ def gen_receipt(font_dir, im_size, font_size, im_padding,
     left_start = cursor[0]
 
     while True:
-        text = gen_text(sizer, im_size[0]-(2*im_padding))
+        text = lines.line(im_size[0]-(2*im_padding))
 
         if cursor[1] + max_letter_height > (im_size[1]-(2*im_padding)):
             break
@@ -259,7 +327,7 @@ def gen_receipt(font_dir, im_size, font_size, im_padding,
 
             all_bbs[letter].append(bb)
 
-            draw.text(cursor, letter, font=font, fill=(0,0,0))
+            draw_glyph(cursor, letter)
             cursor = (cursor[0] + (x2 * kerning), cursor[1])
 
             #draw_bbs(cursor, draw, [bb])
@@ -273,7 +341,7 @@ def gen_receipt(font_dir, im_size, font_size, im_padding,
                 in bbs]
         all_bbs[letter] = bbs
 
-    return image, all_bbs, basename(font_file)
+    return image, all_bbs, font_name
 
 
 def main():
@@ -0,0 +1,149 @@
+""" a bank of pre-generated receipt textures.  generating a texture with
+text_gen is slow, and the deformation and camera randomness in receipts.py
+already make every render unique, so we can generate a pile of textures ahead of
+time, outside of blender, and have the render workers sample from it.
+
+a bank is a directory with two files:
+
+    textures.npy    a (N, height, width) uint8 grayscale array, memory-mapped
+                    by the readers so that sampling a texture is just a read
+    index.json      the bank's texture size, plus each texture's font, layout,
+                    seed, and normalized glyph bounding boxes, in the same
+                    format that text_gen.gen_receipt returns
+"""
+
+import sys
+from os.path import join, exists
+import os
+import json
+import random
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+import text_gen
+
+
+TEXTURES_FILE = "textures.npy"
+INDEX_FILE = "index.json"
+
+
+def _gen_texture(job):
+    """ generates a single bank texture.  runs in a worker process """
+    seed, font_dir, size = job
+    random.seed(seed)
+
+    line_spacing, kerning = text_gen.random_layout()
+    im, bbs, font_used = text_gen.gen_receipt(font_dir, size,
+            text_gen.RECEIPT_FONT_SIZE, text_gen.RECEIPT_PADDING, line_spacing,
+            kerning)
+
+    pixels = np.asarray(im.convert("L"), dtype=np.uint8)
+    entry = {
+        "seed": seed,
+        "font": font_used,
+        "line_spacing": line_spacing,
+        "kerning": kerning,
+        "bbs": bbs,
+    }
+    return pixels, entry
+
+
+def build_bank(bank_dir, num, size, font_dir, processes=None, seed=None):
+    """ generates num textures of size (width, height) in parallel and writes
+    them to bank_dir """
+    if not exists(bank_dir):
+        os.makedirs(bank_dir)
+
+    width, height = size
+    rng = random.Random(seed)
+    jobs = [(rng.getrandbits(32), font_dir, size) for _ in range(num)]
+
+    # we write straight into a memory-mapped file so that a big bank never has
+    # to fit in memory all at once
+    textures = np.lib.format.open_memmap(join(bank_dir, TEXTURES_FILE),
+            mode="w+", dtype=np.uint8, shape=(num, height, width))
+
+    entries = []
+    with Pool(processes) as pool:
+        for i, (pixels, entry) in enumerate(pool.imap(_gen_texture, jobs)):
+            textures[i] = pixels
+            entries.append(entry)
+            print("%d/%d" % (i+1, num))
+
+    textures.flush()
+    del textures
+
+    index = {
+        "size": [width, height],
+        "textures": entries,
+    }
+    with open(join(bank_dir, INDEX_FILE), "w") as h:
+        json.dump(index, h)
+
+
+class TextureBank(object):
+    """ read-only access to a bank built by build_bank.  each texture is handed
+    out at most `reuse` times before every texture in the bank has been handed
+    out that many times, at which point we start over """
+
+    def __init__(self, bank_dir, reuse=1):
+        if reuse < 1:
+            raise ValueError("reuse must be at least 1, got %d" % reuse)
+
+        with open(join(bank_dir, INDEX_FILE), "r") as h:
+            index = json.load(h)
+
+        self.size = tuple(index["size"])
+        self.entries = index["textures"]
+        self.textures = np.load(join(bank_dir, TEXTURES_FILE), mmap_mode="r")
+        self.reuse = reuse
+
+        if len(self.entries) != len(self.textures):
+            raise ValueError("texture bank %r has %d index entries but %d "
+                "textures" % (bank_dir, len(self.entries), len(self.textures)))
+
+        self._remaining = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sample(self):
+        """ picks a random texture and returns (pixels, letter_bbs, font_used).
+        pixels is a read-only view into the memory-mapped bank """
+        if not self._remaining:
+            self._remaining = list(range(len(self))) * self.reuse
+
+        # swap-remove a random pick, so we never rescan the remaining list
+        i = random.randrange(len(self._remaining))
+        self._remaining[i], self._remaining[-1] = self._remaining[-1], \
+                self._remaining[i]
+        idx = self._remaining.pop()
+
+        entry = self.entries[idx]
+        return self.textures[idx], entry["bbs"], entry["font"]
+
+
+def parse_size(s):
+    w, h = s.split("x")
+    return int(w), int(h)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="texture_bank.py")
+    parser.add_argument("-n", "--count", metavar="NUM", type=int,
+            required=True, help="The number of textures to generate")
+    parser.add_argument("-s", "--size", metavar="WxH", type=parse_size,
+            required=True, help="Size of each texture.  The aspect ratio "
+            "must match the receipt mesh")
+    parser.add_argument("-p", "--processes", metavar="NUM", type=int,
+            default=None, help="Number of worker processes, defaults to "
+            "the number of cpus")
+    parser.add_argument("--fonts", metavar="DIR", default=text_gen.FONT_DIR,
+            help="Directory to pick fonts from")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", metavar="DIR", required=True)
+
+    ns = parser.parse_args(sys.argv[1:])
+    build_bank(ns.output, ns.count, ns.size, ns.fonts, ns.processes, ns.seed)
@@ -120,9 +120,16 @@ def a_copy(ctx, scene, ob):
     """ allows us to operate on a copy of an object, which will be cleaned up
     afterwards """
     copy = duplicate(scene, ob)
+    data = copy.data
     try:
         yield copy
     finally:
         scene.objects.unlink(copy)
 
+        # unlinking only takes the copy out of the scene, the datablocks would
+        # otherwise stick around for the rest of the run
+        bpy.data.objects.remove(copy, do_unlink=True)
+        if isinstance(data, bpy.types.Mesh) and data.users == 0:
+            bpy.data.meshes.remove(data, do_unlink=True)
+
 
@@ -0,0 +1,11 @@
+#!/bin/bash
+THIS_DIR="`dirname \"$0\"`"
+THIS_DIR="`( cd \"$THIS_DIR\" && pwd )`"
+
+TARGET=/home/ocr
+docker run -it --rm\
+    -v $THIS_DIR/fonts:$TARGET/fonts\
+    amoffat/receipts\
+    blender/2.78/python/bin/python3.5m font_atlas.py\
+    --fonts $TARGET/fonts/ttfs\
+    $@
@@ -9,6 +9,7 @@ docker run -it --rm\
     -v $THIS_DIR/receipts:$TARGET/receipts:ro\
     -v $THIS_DIR/hdris:$TARGET/hdris:ro\
     -v $THIS_DIR/fonts:$TARGET/fonts:ro\
+    -v $THIS_DIR/textures:$TARGET/textures:ro\
     amoffat/receipts\
     /bin/bash launch_blender.sh\
     --output $TARGET/renders\